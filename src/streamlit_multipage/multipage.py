@@ -1,124 +1,359 @@
 from dataclasses import dataclass, field
-from typing import List, Callable, ClassVar, Any, Dict, NamedTuple
-from collections import defaultdict
+from typing import List, Callable, ClassVar, Any, Dict, Iterable, Iterator, NamedTuple, Tuple
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from functools import wraps
 from pathlib import Path
-import copy
+import json
+import math
+import os
+import pickle
+import sqlite3
+import stat
+import sys
+import threading
 
 import streamlit as st
-from streamlit.runtime.scriptrunner import add_script_run_ctx
+from streamlit.runtime.scriptrunner import get_script_run_ctx
 
 try:
-    import joblib as pickling
+    import orjson
 except ImportError:
-    import pickle as pickling
+    orjson = None
+
+PICKLE_PROTOCOL = pickle.HIGHEST_PROTOCOL
+# Upper bound of the database mapped into memory, reads within it skip the
+# read() syscalls and the copy into sqlite's page cache
+MMAP_SIZE = 256 * 1024 * 1024
+# Every session has its own database, only the most recently used ones keep
+# an open connection (three file descriptors each: db, -wal and -shm)
+MAX_CONNECTIONS = 8
+_JSON_SCALARS = (str, int, bool, type(None))
+
+
+def _is_json_safe(value: Any) -> bool:
+    # Exact types only, anything that would not round-trip unchanged
+    # (tuples, subclasses, datetimes, NaN...) is left to pickle
+    kind = type(value)
+    if kind in _JSON_SCALARS:
+        return True
+    if kind is float:
+        return math.isfinite(value)
+    if kind is list:
+        return all(_is_json_safe(item) for item in value)
+    if kind is dict:
+        return all(type(key) is str and _is_json_safe(item) for key, item in value.items())
+    return False
+
+
+def _json_safe(variables: Dict[str, Any]) -> bool:
+    try:
+        return _is_json_safe(variables)
+    except RecursionError:
+        # Self-referencing containers, pickle handles those
+        return False
+
+
+def _dumps(variables: Dict[str, Any]) -> bytes:
+    if orjson is not None and _json_safe(variables):
+        try:
+            return orjson.dumps(variables)
+        except TypeError:
+            # e.g. integers that do not fit in 64 bits
+            pass
+    return pickle.dumps(variables, protocol=PICKLE_PROTOCOL)
+
+
+def _loads(blob: bytes) -> Dict[str, Any]:
+    # A namespace encoded as JSON always starts with "{", a pickle with its
+    # PROTO opcode
+    if blob[:1] == b"{":
+        return orjson.loads(blob) if orjson is not None else json.loads(blob)
+    return pickle.loads(blob)
+
+
+def _private_dir(path: Path) -> bool:
+    # The name is predictable and /dev/shm is shared by all users, only use
+    # a directory that is ours and not accessible to anyone else
+    try:
+        path.mkdir(mode=0o700, exist_ok=True)
+        info = path.lstat()
+    except OSError:
+        return False
+    return (
+        stat.S_ISDIR(info.st_mode)
+        and info.st_uid == os.getuid()
+        and stat.S_IMODE(info.st_mode) == 0o700
+    )
+
+
+def _default_cache() -> Path:
+    # Session caches are throwaway, keep them in memory (tmpfs) where the
+    # platform offers it and next to the package otherwise
+    shm = Path("/dev/shm")
+    if hasattr(os, "getuid") and shm.is_dir() and os.access(shm, os.W_OK):
+        cache = shm / f"streamlit_multipage-{os.getuid()}"
+        if _private_dir(cache):
+            return cache
+    return Path(__file__).resolve().parent / "cache"
+
+
+def _locked(method: Callable) -> Callable:
+    # The module level state is shared by the script threads of all sessions.
+    # Connections, the in-memory cache and the LRU eviction are only touched
+    # while holding the lock, so no connection is closed while in use.
+    @wraps(method)
+    def wrapper(self: "StateManager", *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 @dataclass
 class StateManager:
     path: Path = Path(__file__).resolve().parent
-    cache: Path = path / "cache"
-    cache_filename: str = "data.pkl"
+    cache: Path = field(default_factory=_default_cache)
+    cache_filename: str = "data.db"
+    _connections: "OrderedDict[Path, sqlite3.Connection]" = field(
+        default_factory=OrderedDict, init=False, repr=False
+    )
+    _mem_cache: Dict[Path, Tuple[int, Dict[str, bytes], Dict[str, int]]] = field(
+        default_factory=dict, init=False, repr=False
+    )
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False)
 
     @property
     def cache_file(self) -> Path:
         return self.cache / self.cache_filename
 
+    # The current page is UI state of the browser session, it is kept in
+    # st.session_state rather than in the cache file
     def change_page(self, page: int) -> None:
-        self.save({"current_page": page}, ["global"])
+        st.session_state["__mp_current_page"] = page
 
-    def read_current_page(self) -> int:        
-        data = self.load()["global"]
-        if "current_page" in data:
-            return int(data["current_page"])
-        return 0
+    def read_current_page(self) -> int:
+        return int(st.session_state.get("__mp_current_page", 0))
 
-    @st.cache(suppress_st_warning=True)
     def _initialize(self, initial_page: int) -> None:
+        # Runs once per browser session
+        if st.session_state.setdefault("__mp_initialized", False):
+            return
+        st.session_state["__mp_initialized"] = True
         self.change_page(initial_page)
 
+    @_locked
     def save(self, variables: Dict[str, Any], namespaces: List[str] = None) -> None:
         if not variables:
             return
         
         if namespaces is None:
-            namespaces = ["global"]
+            namespaces = ("global",)
 
-        data = self.load()
+        # Only the namespaces being updated are rewritten
+        cached = self._cached()
+        data = {}
 
-        new_data = {namespace: variables for namespace in namespaces}
+        for namespace in namespaces:
+            bucket = cached.get(namespace)
+            data[namespace] = {**_loads(bucket), **variables} if bucket else dict(variables)
 
-        for namespace, variables in new_data.items():
-            if namespace in data:
-                data[namespace].update(variables)
-                continue
+        self._save(data)
 
-            data[namespace] = variables
+    def _connect(self) -> sqlite3.Connection:
+        cache_file = self.cache_file
+        connection = self._connections.get(cache_file)
+        if connection is not None:
+            self._connections.move_to_end(cache_file)
+            return connection
+
+        self.cache.mkdir(mode=0o700, parents=True, exist_ok=True)
+        connection = sqlite3.connect(cache_file, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "namespace TEXT PRIMARY KEY, blob BLOB NOT NULL, version INTEGER NOT NULL)"
+        )
+        # Table-wide counter for the row versions, so a namespace that is
+        # deleted and saved again never reuses a version a reader has seen
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS counter (id INTEGER PRIMARY KEY CHECK (id = 0), value INTEGER NOT NULL)"
+        )
+        connection.execute("INSERT OR IGNORE INTO counter (id, value) VALUES (0, 0)")
+        self._connections[cache_file] = connection
 
-        self._save(data)
+        while len(self._connections) > MAX_CONNECTIONS:
+            self._disconnect(next(iter(self._connections)))
+
+        return connection
+
+    def _disconnect(self, cache_file: Path = None) -> None:
+        if cache_file is None:
+            cache_file = self.cache_file
+
+        self._mem_cache.pop(cache_file, None)
+        connection = self._connections.pop(cache_file, None)
+        if connection is not None:
+            connection.close()
+
+    @contextmanager
+    def _transaction(self, mode: str = "IMMEDIATE") -> Iterator[sqlite3.Connection]:
+        # Group all statements in a single commit so readers never see a
+        # partially applied save spanning several namespaces
+        connection = self._connect()
+        connection.execute(f"BEGIN {mode}")
+        try:
+            yield connection
+            connection.execute("COMMIT")
+        except BaseException:
+            # Also covers a failed COMMIT (e.g. SQLITE_BUSY), the cached
+            # connection must not stay inside the open transaction
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
 
     def _save(self, data: Dict[str, Any]) -> None:
-        self.cache.mkdir(parents=True, exist_ok=True)
-        pickling.dump(data, open(self.cache_file, 'wb'))
+        # Nothing to write, do not take the write lock or bump the counter
+        if not data:
+            return
 
+        rows = [
+            (namespace, _dumps(variables))
+            for namespace, variables in data.items()
+        ]
+        with self._transaction() as connection:
+            connection.execute("UPDATE counter SET value = value + 1")
+            connection.executemany(
+                "INSERT INTO state (namespace, blob, version) VALUES (?, ?, (SELECT value FROM counter)) "
+                "ON CONFLICT(namespace) DO UPDATE SET blob = excluded.blob, version = excluded.version",
+                rows,
+            )
+            versions = self._versions(connection, data.keys())
+
+        self._cached().update(rows)
+        self._mem_cache[self.cache_file][2].update(versions)
+
+    def _delete(self, namespaces: Iterable[str]) -> None:
+        namespaces = list(namespaces)
+        if not namespaces:
+            return
+
+        with self._transaction() as connection:
+            connection.executemany(
+                "DELETE FROM state WHERE namespace = ?",
+                [(namespace,) for namespace in namespaces],
+            )
+        cached = self._cached()
+        versions = self._mem_cache[self.cache_file][2]
+        for namespace in namespaces:
+            cached.pop(namespace, None)
+            versions.pop(namespace, None)
+
+    @_locked
     def load(self) -> Dict[str, Any]:
         if not self.cache_file.exists():
             return defaultdict(dict)
         
-        data = self._load()
+        data = defaultdict(dict, {namespace: _loads(blob) for namespace, blob in self._cached().items()})
         
         if "global" in data:
             data.update(data["global"])
 
         return data
 
-    def _load(self) -> Dict[str, Any]:
-        try:
-            return pickling.load(open(self.cache_file, 'rb'))
-        except EOFError:
-            return defaultdict(dict)
+    @staticmethod
+    def _versions(connection: sqlite3.Connection, namespaces: Iterable[str] = None) -> Dict[str, int]:
+        query = "SELECT namespace, version FROM state"
+        parameters = ()
+
+        if namespaces is not None:
+            parameters = tuple(namespaces)
+            query += f" WHERE namespace IN ({', '.join('?' * len(parameters))})"
+
+        return dict(connection.execute(query, parameters))
 
+    @staticmethod
+    def _load(connection: sqlite3.Connection, namespaces: Iterable[str]) -> Dict[str, bytes]:
+        parameters = tuple(namespaces)
+        if not parameters:
+            return {}
+
+        rows = connection.execute(
+            f"SELECT namespace, blob FROM state WHERE namespace IN ({', '.join('?' * len(parameters))})",
+            parameters,
+        )
+        return dict(rows)
+
+    def _cached(self) -> Dict[str, bytes]:
+        # data_version only changes when another connection commits, our own
+        # writes keep the in-memory copy up to date. The cache holds the
+        # encoded rows: every reader decodes its own objects, so nothing handed
+        # out to callers, nested values included, can leak back into it.
+        data_version = self._connect().execute("PRAGMA data_version").fetchone()[0]
+        cached = self._mem_cache.get(self.cache_file)
+        if cached is not None and cached[0] == data_version:
+            return cached[1]
+
+        _, data, versions = cached if cached is not None else (None, defaultdict(dict), {})
+
+        # Only namespaces whose row version moved are fetched again
+        with self._transaction("DEFERRED") as connection:
+            current = self._versions(connection)
+            stale = [namespace for namespace, version in current.items() if versions.get(namespace) != version]
+            fresh = self._load(connection, stale)
+
+        for namespace in set(data) - set(current):
+            del data[namespace]
+        data.update(fresh)
+
+        self._mem_cache[self.cache_file] = (data_version, data, current)
+        return data
+
+    @_locked
     def is_logged_in(self) -> bool:
-        return "username" in self.load().get('session', '') and "token" in self.load().get('session', '')
+        # Only the session namespace is needed, skip the merged copy load() builds
+        if not self.cache_file.exists():
+            return False
 
+        blob = self._cached().get('session')
+        if blob is None:
+            return False
+
+        session = _loads(blob)
+        return "username" in session and "token" in session
+
+    @_locked
     def clear_cache(self, *, 
                     variables: Dict[str, Any] = None, 
                     namespaces: List[str] = None, 
                     all_variables: bool = False) -> None:
-                
-        data = self.load()
-        temp_data = copy.deepcopy(data)
 
-        # Delete all variables from all namespaces
+        # Delete the cache file if all data are to be erased
         if all_variables:
-            for namespace in temp_data.keys():
-                try:
-                    del data[namespace]
-                except KeyError:
-                    ...
-        
+            self._disconnect()
+            if self.cache_filename:
+                for suffix in ("", "-wal", "-shm"):
+                    Path(f"{self.cache_file}{suffix}").unlink(missing_ok=True)
+
         # Delete all variables for given namespace list
         elif namespaces and not variables:
-            for namespace in namespaces:
-                try:
-                    del data[namespace]
-                except KeyError:
-                    ...
-        
+            self._delete(namespaces)
+
         # Delete given variables from all namespaces
         elif variables:
-            for namespace in temp_data.keys():
+            data = {namespace: _loads(stored) for namespace, stored in self._cached().items()}
+            changed = {}
+
+            for namespace in list(data.keys()):
                 for variable in variables:
                     try:
                         del data[namespace][variable]
+                        changed[namespace] = data[namespace]
                     except KeyError:
                         ...
-                            
-        self._save(data)
 
-        # Delete cache file if all data are to be erased 
-        if all_variables:
-            if self.cache_filename:
-                self.cache_file.unlink(missing_ok=True)
+            self._save(changed)
 
 
 state = StateManager()
@@ -129,63 +364,72 @@ class App(NamedTuple):
     func: Callable
 
 
-@dataclass
+_HIDE_MENU_HTML = """
+    <style>
+    #MainMenu {display: none;}
+    footer {visibility: hidden;}
+    </style>
+"""
+
+
+# Slots turn attribute reads on the render path into plain slot lookups,
+# the option only exists on Python 3.10+
+_DATACLASS_SLOTS = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+@dataclass(**_DATACLASS_SLOTS)
 class MultiPage:
-    st = None
-    __apps: List[App] = field(default_factory=list)
-    __initial_page: App = None
+    apps: List[App] = field(default_factory=list)
+    _initial_page: App = None
     __state_manager: ClassVar[StateManager] = state
-    __header: App = None
-    __footer: App = None
-    __navbar_extra: App = None
+    _header: App = None
+    _footer: App = None
+    _navbar_extra: App = None
     start_button: str = "Let's go!"
     navbar_name: str = "Navigation"
     next_page_button: str = "Next Page"
     previous_page_button: str = "Previous Page"
     reset_button: str = "Reset Cache"
-    navbar_style = "Button"
+    navbar_style: str = "Button"
     hide_menu: bool = False
     hide_navigation: bool = False
-
-    @property
-    def apps(self) -> List[App]:
-        return self.__apps
+    st: Any = None
 
     @property
     def initial_page(self) -> App:
-        return self.__initial_page
+        return self._initial_page
 
     @initial_page.setter
     def initial_page(self, value: Callable) -> None:
-        self.__initial_page = App("__INITIALPAGE__", value)      
+        self._initial_page = App("__INITIALPAGE__", value)      
 
     @property
     def header(self) -> App:
-        return self.__header
+        return self._header
 
     @header.setter
     def header(self, value: Callable) -> None:
-        self.__header = App("Header", value)
+        self._header = App("Header", value)
 
     @property
     def footer(self) -> App:
-        return self.__footer
+        return self._footer
 
     @footer.setter
     def footer(self, value: Callable) -> None:
-        self.__footer = App("Footer", value)
+        self._footer = App("Footer", value)
 
     @property
     def navbar_extra(self) -> App:
-        return self.__navbar_extra
+        return self._navbar_extra
 
     @navbar_extra.setter
     def navbar_extra(self, value: Callable) -> None:
-        self.__navbar_extra = App("Navbar_extra", value)
+        self._navbar_extra = App("Navbar_extra", value)
 
     def add_app(self, name: str, func: Callable, initial_page: bool = False) -> None:
         # only first occurrence
-        if initial_page and not self.initial_page:
+        if initial_page and not self._initial_page:
             self.initial_page = func
             return
 
@@ -194,18 +438,23 @@ class MultiPage:
 
     def _render_next_previous(self, sidebar):
         left_column, middle_column, right_column = sidebar.columns(3)
-        page = self.__state_manager.read_current_page()
 
-        if middle_column.button(self.reset_button):
+        # Every button has to be rendered to stay on screen, at most one of
+        # them is clicked per rerun
+        reset = middle_column.button(self.reset_button, key="__mp_reset")
+        previous = left_column.button(self.previous_page_button, key="__mp_previous")
+        next_ = right_column.button(self.next_page_button, key="__mp_next")
+
+        if reset:
             self.change_page(-1)
 
-        if left_column.button(self.previous_page_button):
-            page = max(0, page - 1)
-            self.change_page(page)
+        elif previous:
+            page = self.__state_manager.read_current_page()
+            self.change_page(max(0, page - 1))
 
-        if right_column.button(self.next_page_button):
-            page = min(len(self.apps) - 1, page + 1)
-            self.change_page(page)
+        elif next_:
+            page = self.__state_manager.read_current_page()
+            self.change_page(min(len(self.apps) - 1, page + 1))
 
     def _render_navbar(self, sidebar) -> None:
 
@@ -228,51 +477,44 @@ class MultiPage:
             if self.navbar_style == "HorizontalButton":
                 columns = sidebar.columns(len(self.apps))
                 for index, (column, app) in enumerate(zip(columns, self.apps)):
-                    if column.button(app.name):
+                    if column.button(app.name, key=f"__mp_nav_{index}"):
                         self.change_page(index)
 
             elif self.navbar_style == "VerticalButton":
                 for index, app in enumerate(self.apps):
-                    if sidebar.button(app.name, use_container_width=True):
+                    if sidebar.button(app.name, use_container_width=True, key=f"__mp_nav_{index}"):
                         self.change_page(index)
 
         if self.navbar_style == "SelectBox":
-            app_names = [app.name for app in self.apps]
-            app_name = sidebar.selectbox("", app_names)
-            next_page = app_names.index(app_name)
+            # Options are page indices, so the choice maps to a page without
+            # searching and always reflects the current apps list
+            next_page = sidebar.selectbox(
+                "", range(len(self.apps)), format_func=lambda index: self.apps[index].name
+            )
             self.change_page(next_page)
 
         sidebar.write("---")
 
-        if self.navbar_extra:
-            self.navbar_extra.func(self, sidebar)
+        if self._navbar_extra:
+            self._navbar_extra.func(self, sidebar)
 
     def _run(self) -> None:
+        logged_in = self.is_logged_in()
 
-        if not self.is_logged_in() or self.hide_menu:
-            hide_menu = """
-                <style>
-                #MainMenu {display: none;}
-                footer {visibility: hidden;}
-                </style>
-            """
-            st.markdown(hide_menu, unsafe_allow_html=True)
+        if not logged_in or self.hide_menu:
+            st.markdown(_HIDE_MENU_HTML, unsafe_allow_html=True)
 
         # If not logged in - load initial page
-        if not self.is_logged_in():
-            self.initial_page.func(self)
+        if not logged_in:
+            self._initial_page.func(self)
         
         # If logged in - load hole page    
         else:
-            if self.header:
-                self.header.func(self)
+            if self._header:
+                self._header.func(self)
     
             self._render_navbar(st.sidebar)
 
-            if not self.is_logged_in():
-                self.initial_page.func(self)
-                return
-
             page = self.__state_manager.read_current_page()
             if page >= len(self.apps):
                 page = 0
@@ -280,15 +522,19 @@ class MultiPage:
             app = self.apps[page]
             app.func(self)
     
-            if self.footer:
-                self.footer.func(self)
+            if self._footer:
+                self._footer.func(self)
 
     def run(self, avoid_collisions: bool = True) -> None:
         if avoid_collisions:
-            session_id = add_script_run_ctx().streamlit_script_run_ctx.session_id
-            cache_filename = f"{session_id}.pkl"
-            if cache_filename != self.__state_manager.cache_filename:
-                self.__state_manager.cache_filename = cache_filename
+            # MultiPage is rebuilt on every rerun, so the per-session file name
+            # is kept in st.session_state. The state manager is shared by all
+            # sessions and still has to be pointed at it on each run.
+            cache_filename = st.session_state.get("__mp_cache_filename")
+            if cache_filename is None:
+                cache_filename = f"{get_script_run_ctx().session_id}.db"
+                st.session_state["__mp_cache_filename"] = cache_filename
+            self.__state_manager.cache_filename = cache_filename
             self._run()
     
     def clear_cache(self, *, 